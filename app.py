@@ -1,5 +1,5 @@
 import streamlit as st
-from PIL import Image, ImageDraw, UnidentifiedImageError
+from PIL import UnidentifiedImageError
 import numpy as np
 import io
 import zipfile
@@ -8,6 +8,17 @@ import sys
 import os
 import time
 import requests 
+import uuid
+from swatch_core import (
+    shorten_filename, is_valid_image_header, extract_palette, load_image, is_within_dimensions,
+    prepare_image, safe_output_filename, encode_image, render_position, make_preview_thumbnail, fetch_image_url,
+    ImageTooLargeError, QUANT_METHOD_MAP, FORMAT_MAP, SETTING_RANGES,
+)
+from memory_budget import estimate_image_peak_bytes, get_default_scheduler
+from batch_jobs import open_job, input_digest, utc_timestamp
+
+# Set SWATCH_JOBS_DIR to keep outputs and a manifest on disk, so a batch survives reruns and restarts
+JOBS_DIR = os.environ.get("SWATCH_JOBS_DIR")
 
 # --- Page Setup ---
 st.set_page_config(layout="wide")
@@ -28,7 +39,8 @@ default_session_state = {
     'file_uploader_key': "file_uploader_0",
     'processed_sources_cache': [], 
     'image_url_current_input': "",
-    'download_completed_message': False 
+    'download_completed_message': False,
+    'session_id': uuid.uuid4().hex # Key for the per-session memory budget
 }
 
 for key, value in default_session_state.items():
@@ -180,150 +192,6 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-# --- Utility Functions ---
-def shorten_filename(filename, max_len=25, front_chars=10, back_chars=10):
-    if len(filename) > max_len:
-        name, ext = os.path.splitext(filename)
-        back_chars_name = max(0, back_chars - len(ext))
-        return f"{name[:front_chars]}...{name[-back_chars_name:]}{ext}"
-    return filename
-
-def is_valid_image_header(file_bytes):
-    header = file_bytes[:12]
-    if header.startswith(b'\xFF\xD8\xFF'): return 'jpeg'
-    if header.startswith(b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'): return 'png'
-    if header.startswith(b'\x47\x49\x46\x38\x37\x61') or header.startswith(b'\x47\x49\x46\x38\x39\x61'): return 'gif'
-    if header.startswith(b'\x42\x4D'): return 'bmp'
-    if header.startswith(b'\x49\x49\x2A\x00') or header.startswith(b'\x4D\x4D\x00\x2A'): return 'tiff'
-    if header.startswith(b'\x52\x49\x46\x46') and header[8:12] == b'\x57\x45\x42\x50': return 'webp'
-    if header.startswith(b'\x00\x00\x01\x00') or header.startswith(b'\x00\x00\x02\x00'): return 'ico'
-    return None
-
-# --- Color Extraction ---
-def extract_palette(image, num_colors=6, quantize_method=Image.MEDIANCUT):
-    img = image.convert("RGB")
-    try:
-        paletted = img.quantize(colors=num_colors, method=quantize_method, kmeans=5)
-        palette_full = paletted.getpalette()
-        if palette_full is None:
-            paletted = img.quantize(colors=num_colors, method=Image.FASTOCTREE, kmeans=5)
-            palette_full = paletted.getpalette()
-            if palette_full is None: return []
-        
-        actual_palette_colors = len(palette_full) // 3
-        colors_to_extract = min(num_colors, actual_palette_colors)
-        extracted_palette_rgb_values = palette_full[:colors_to_extract * 3]
-        return [tuple(extracted_palette_rgb_values[i:i+3]) for i in range(0, len(extracted_palette_rgb_values), 3)]
-    except Exception:
-        try:
-            paletted = img.quantize(colors=num_colors, method=Image.FASTOCTREE, kmeans=5)
-            palette = paletted.getpalette()
-            if palette is None: return []
-            return [tuple(palette[i:i+3]) for i in range(0, min(num_colors * 3, len(palette)), 3)]
-        except Exception:
-            return []
-
-# --- Draw Layout Function ---
-def draw_layout(image, colors, position, 
-                image_border_percent, swatch_separator_percent, individual_swatch_border_percent,
-                border_color, swatch_border_color, swatch_size_percent_of_shorter_dim):
-    img_w, img_h = image.size
-    shorter_dimension = min(img_w, img_h)
-
-    image_border_thickness_px = int(shorter_dimension * (image_border_percent / 100))
-    swatch_separator_thickness_px = int(shorter_dimension * (swatch_separator_percent / 100))
-    individual_swatch_border_thickness_px = int(shorter_dimension * (individual_swatch_border_percent / 100))
-
-    if image_border_percent > 0 and image_border_thickness_px == 0: image_border_thickness_px = 1
-    if swatch_separator_percent > 0 and swatch_separator_thickness_px == 0: swatch_separator_thickness_px = 1
-    if individual_swatch_border_percent > 0 and individual_swatch_border_thickness_px == 0: individual_swatch_border_thickness_px = 1
-    
-    main_border = image_border_thickness_px
-    actual_swatch_size_px = int(shorter_dimension * (swatch_size_percent_of_shorter_dim / 100))
-    if actual_swatch_size_px <= 0 and swatch_size_percent_of_shorter_dim > 0 : actual_swatch_size_px = 1
-    elif actual_swatch_size_px <= 0: actual_swatch_size_px = 0
-
-    if not colors:
-        if main_border > 0:
-            canvas = Image.new("RGB", (img_w + 2 * main_border, img_h + 2 * main_border), border_color)
-            canvas.paste(image, (main_border, main_border))
-            return canvas
-        return image.copy()
-
-    swatch_width = 0; swatch_height = 0
-    extra_width_for_last_swatch = 0; extra_height_for_last_swatch = 0
-    image_paste_x = main_border; image_paste_y = main_border
-
-    common_canvas_args = {"width_add": 0, "height_add": 0, "swatch_x_or_y_coord": main_border, "paste_offset_dim": 0}
-
-    if position in ['top', 'bottom']:
-        common_canvas_args["height_add"] = actual_swatch_size_px + swatch_separator_thickness_px
-        swatch_total_dim = img_w
-        if len(colors) > 0: swatch_width = swatch_total_dim // len(colors)
-        extra_width_for_last_swatch = swatch_total_dim % len(colors) if len(colors) > 0 else 0
-        if position == 'top':
-            common_canvas_args["paste_offset_dim"] = actual_swatch_size_px + swatch_separator_thickness_px
-            image_paste_y = main_border + common_canvas_args["paste_offset_dim"]
-        else: # bottom
-            common_canvas_args["swatch_x_or_y_coord"] = main_border + img_h + swatch_separator_thickness_px
-    elif position in ['left', 'right']:
-        common_canvas_args["width_add"] = actual_swatch_size_px + swatch_separator_thickness_px
-        swatch_total_dim = img_h
-        if len(colors) > 0: swatch_height = swatch_total_dim // len(colors)
-        extra_height_for_last_swatch = swatch_total_dim % len(colors) if len(colors) > 0 else 0
-        if position == 'left':
-            common_canvas_args["paste_offset_dim"] = actual_swatch_size_px + swatch_separator_thickness_px
-            image_paste_x = main_border + common_canvas_args["paste_offset_dim"]
-        else: # right
-            common_canvas_args["swatch_x_or_y_coord"] = main_border + img_w + swatch_separator_thickness_px
-    else: return image.copy()
-
-    canvas_w = img_w + 2 * main_border + common_canvas_args["width_add"]
-    canvas_h = img_h + 2 * main_border + common_canvas_args["height_add"]
-    
-    canvas = Image.new("RGB", (canvas_w, canvas_h), border_color)
-    canvas.paste(image, (image_paste_x, image_paste_y))
-    draw = ImageDraw.Draw(canvas)
-
-    swatch_x_current = common_canvas_args["swatch_x_or_y_coord"] if position in ['left', 'right'] else main_border
-    swatch_y_current = common_canvas_args["swatch_x_or_y_coord"] if position in ['top', 'bottom'] else main_border
-
-    for i, color_tuple in enumerate(colors):
-        current_sw_w = swatch_width + (extra_width_for_last_swatch if i == len(colors) -1 else 0)
-        current_sw_h = swatch_height + (extra_height_for_last_swatch if i == len(colors) -1 else 0)
-
-        if position in ['top', 'bottom']:
-            rect = [swatch_x_current, swatch_y_current, swatch_x_current + current_sw_w, swatch_y_current + actual_swatch_size_px]
-            draw.rectangle(rect, fill=tuple(color_tuple))
-            if individual_swatch_border_thickness_px > 0 and i < len(colors) - 1:
-                draw.line([(rect[2], rect[1]), (rect[2], rect[3])], fill=swatch_border_color, width=individual_swatch_border_thickness_px)
-            swatch_x_current += current_sw_w
-        else: # left or right
-            rect = [swatch_x_current, swatch_y_current, swatch_x_current + actual_swatch_size_px, swatch_y_current + current_sw_h]
-            draw.rectangle(rect, fill=tuple(color_tuple))
-            if individual_swatch_border_thickness_px > 0 and i < len(colors) - 1:
-                draw.line([(rect[0], rect[3]), (rect[2], rect[3])], fill=swatch_border_color, width=individual_swatch_border_thickness_px)
-            swatch_y_current += current_sw_h
-            
-    if main_border > 0:
-        draw.rectangle([0,0, canvas_w-1, canvas_h-1], outline=border_color, width=main_border)
-
-    if swatch_separator_thickness_px > 0 and actual_swatch_size_px > 0:
-        if position == 'top':
-            line_y = main_border + actual_swatch_size_px
-            draw.line([(main_border, line_y), (canvas_w - main_border -1, line_y)], fill=swatch_border_color, width=swatch_separator_thickness_px)
-        elif position == 'bottom':
-            line_y = main_border + img_h 
-            draw.line([(main_border, line_y), (canvas_w - main_border-1, line_y)], fill=swatch_border_color, width=swatch_separator_thickness_px)
-        elif position == 'left':
-            line_x = main_border + actual_swatch_size_px
-            draw.line([(line_x, main_border), (line_x, canvas_h - main_border -1)], fill=swatch_border_color, width=swatch_separator_thickness_px)
-        elif position == 'right':
-            line_x = main_border + img_w
-            draw.line([(line_x, main_border), (line_x, canvas_h - main_border-1)], fill=swatch_border_color, width=swatch_separator_thickness_px)
-    return canvas
-
-
 # --- Function to get current settings tuple and hash ---
 def get_settings_tuple_and_hash(all_image_sources_list, positions_list, output_format_val, webp_lossless_val,
                                 quant_method_label_val, num_colors_val, swatch_size_val,
@@ -398,17 +266,9 @@ try:
     if current_url_to_process and current_url_to_process not in processed_input_identifiers:
         try:
             st.info(f"Fetching from URL: {current_url_to_process}...")
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            response = requests.get(current_url_to_process, timeout=15, headers=headers, stream=True)
-            response.raise_for_status()
-            if int(response.headers.get('Content-Length', 0)) > 20 * 1024 * 1024:
-                st.error(f"Image from URL is too large (>20MB). Skipped."); raise Exception("File too large")
-
-            image_bytes = response.content
-            url_file_name_base = os.path.basename(current_url_to_process.split("?")[0].strip()) or "image_from_url"
-            detected_format = is_valid_image_header(image_bytes[:12])
-            if detected_format:
-                final_url_file_name = f"{os.path.splitext(url_file_name_base)[0]}.{detected_format}"
+            fetched = fetch_image_url(current_url_to_process)
+            if fetched:
+                final_url_file_name, image_bytes = fetched
                 source_data = {'name': final_url_file_name, 'bytes': image_bytes, 'source_type': 'url', 'original_input': current_url_to_process}
                 all_image_sources.append(source_data)
                 processed_input_identifiers.add(current_url_to_process)
@@ -418,18 +278,16 @@ try:
                 st.session_state.image_url_current_input = "" 
                 st.rerun() 
             else: st.warning(f"Could not validate image from URL. Skipped.")
+        except ImageTooLargeError: st.error(f"Image from URL is too large (>20MB). Skipped.")
         except requests.exceptions.MissingSchema: st.error(f"Invalid URL. Include http:// or https://.")
         except requests.exceptions.RequestException as e: st.error(f"Error fetching URL: {e}.")
-        except Exception as e: 
-            if "File too large" not in str(e): 
-                st.error(f"Error processing URL: {e}")
+        except Exception as e: st.error(f"Error processing URL: {e}")
     
     with col1:
         st.subheader("Output Options") 
         output_format = st.selectbox("Output format", ["JPG", "PNG", "WEBP"], key="output_format")
         webp_lossless = st.checkbox("Lossless WEBP", value=False, key="webp_lossless") if output_format == "WEBP" else False
-        format_map = {"JPG": ("JPEG", "jpg"), "PNG": ("PNG", "png"), "WEBP": ("WEBP", "webp")}
-        img_format, extension = format_map[output_format]
+        img_format, extension = FORMAT_MAP[output_format]
 
     with col2:
         st.subheader("Layout Settings") 
@@ -442,16 +300,15 @@ try:
         if col2_row2[1].toggle("Right", value=False, key="pos_right"): positions.append("right")
 
         quant_method_label = st.selectbox("Palette extraction", ["MEDIANCUT", "MAXCOVERAGE", "FASTOCTREE"], 0, key="quant_method")
-        quant_method_map = {"MEDIANCUT": Image.MEDIANCUT, "MAXCOVERAGE": Image.MAXCOVERAGE, "FASTOCTREE": Image.FASTOCTREE}
-        quantize_method_selected = quant_method_map[quant_method_label]
-        num_colors = st.slider("Number of swatches", 2, 12, 6, key="num_colors")
-        swatch_size_percent_val = st.slider("Swatch size (% of shorter image dim.)", 0.0, 100.0, 20.0, step=0.5, key="swatch_size_percent")
+        quantize_method_selected = QUANT_METHOD_MAP[quant_method_label]
+        num_colors = st.slider("Number of swatches", *SETTING_RANGES['num_colors'], 6, key="num_colors")
+        swatch_size_percent_val = st.slider("Swatch size (% of shorter image dim.)", *SETTING_RANGES['swatch_size_percent'], 20.0, step=0.5, key="swatch_size_percent")
 
     with col3:
         st.subheader("Borders & Lines") 
-        image_border_thickness_percent_val = st.slider("Image Border (%)", 0.0, 20.0, 5.0, step=0.1, key="image_border_thickness_percent")
-        swatch_separator_thickness_percent_val = st.slider("Swatch-Image Separator (%)", 0.0, 20.0, 3.5, step=0.1, key="swatch_separator_thickness_percent")
-        individual_swatch_border_thickness_percent_val = st.slider("Individual Swatch Border (%)", 0.0, 20.0, 5.0, step=0.1, key="individual_swatch_border_thickness_percent")
+        image_border_thickness_percent_val = st.slider("Image Border (%)", *SETTING_RANGES['image_border_percent'], 5.0, step=0.1, key="image_border_thickness_percent")
+        swatch_separator_thickness_percent_val = st.slider("Swatch-Image Separator (%)", *SETTING_RANGES['swatch_separator_percent'], 3.5, step=0.1, key="swatch_separator_thickness_percent")
+        individual_swatch_border_thickness_percent_val = st.slider("Individual Swatch Border (%)", *SETTING_RANGES['individual_swatch_border_percent'], 5.0, step=0.1, key="individual_swatch_border_thickness_percent")
         border_color = st.color_picker("Main Border Color", "#FFFFFF", key="border_color")
         swatch_border_color = st.color_picker("Swatch Border Color", "#FFFFFF", key="swatch_border_color")
 
@@ -517,6 +374,17 @@ try:
             zip_buffer_current_run = io.BytesIO()
             
             st.session_state.current_settings_hash_at_generation_start = st.session_state.current_settings_hash
+            job_settings = {
+                'swatch_size_percent': swatch_size_percent_val,
+                'image_border_percent': image_border_thickness_percent_val,
+                'swatch_separator_percent': swatch_separator_thickness_percent_val,
+                'individual_swatch_border_percent': individual_swatch_border_thickness_percent_val,
+                'border_color': border_color, 'swatch_border_color': swatch_border_color,
+                'output_format': output_format, 'webp_lossless': webp_lossless,
+                'quant_method': quant_method_label, 'num_colors': num_colors,
+            }
+            memory_scheduler = get_default_scheduler()
+            batch_manifest = open_job(JOBS_DIR, job_settings) if JOBS_DIR else None
 
             with zipfile.ZipFile(zip_buffer_current_run, "a", zipfile.ZIP_DEFLATED, compresslevel=0) as zipf:
                 processed_count_this_run = 0
@@ -524,18 +392,35 @@ try:
                 for source_item in images_to_process_this_run:
                     if generation_interrupted: break
                     file_name = source_item['name']; image_bytes = source_item['bytes']
+                    memory_ticket = None
+                    source_started_at = utc_timestamp(); output_started = time.perf_counter()
+                    resumed_records = {}
+                    if batch_manifest:
+                        source_digest = input_digest(image_bytes)
+                        for pos in positions:
+                            # Without a stored thumbnail the preview would need the full canvas decoded; render again instead
+                            record = batch_manifest.completed(source_digest, pos, need_thumbnail=True)
+                            if record: resumed_records[pos] = record
                     try:
-                        img_pil = Image.open(io.BytesIO(image_bytes)); img_pil.verify()
-                        img_pil = Image.open(io.BytesIO(image_bytes)) 
-                        w, h = img_pil.size
-                        if not (10 <= w <= 15000 and 10 <= h <= 15000):
-                            st.warning(f"`{file_name}` ({w}x{h}) outside dimensions. Skipped.")
-                            processed_count_this_run += len(positions)
-                            processed_count_this_run = min(processed_count_this_run, current_processing_limit)
-                            preloader_and_status_container.markdown(f"<div class='preloader-area'><div class='preloader'></div><span class='preloader-text'>Generating ({processed_count_this_run}/{current_processing_limit})...</span></div>", unsafe_allow_html=True)
-                            continue
-                        if img_pil.mode not in ("RGB", "L"): img_pil = img_pil.convert("RGB")
-                        palette = extract_palette(img_pil, num_colors, quantize_method_selected)
+                        if len(resumed_records) < len(positions):
+                            img_pil = load_image(image_bytes)
+                            w, h = img_pil.size
+                            if not is_within_dimensions(w, h):
+                                st.warning(f"`{file_name}` ({w}x{h}) outside dimensions. Skipped.")
+                                if batch_manifest: batch_manifest.record_failure(source_digest, file_name, positions, 'skipped', f"{w}x{h} outside dimensions", source_started_at, (time.perf_counter() - output_started) * 1000)
+                                processed_count_this_run += len(positions)
+                                processed_count_this_run = min(processed_count_this_run, current_processing_limit)
+                                preloader_and_status_container.markdown(f"<div class='preloader-area'><div class='preloader'></div><span class='preloader-text'>Generating ({processed_count_this_run}/{current_processing_limit})...</span></div>", unsafe_allow_html=True)
+                                continue
+                            # Header-only estimate; wait here while other work holds the memory budget
+                            memory_estimate = estimate_image_peak_bytes(w, h, img_pil.mode, positions, job_settings)
+                            memory_ticket = memory_scheduler.acquire(memory_estimate, st.session_state.session_id, timeout=0)
+                            if memory_ticket is None:
+                                preloader_and_status_container.markdown(f"<div class='preloader-area'><div class='preloader'></div><span class='preloader-text'>Waiting for server capacity ({processed_count_this_run}/{current_processing_limit})...</span></div>", unsafe_allow_html=True)
+                                memory_ticket = memory_scheduler.acquire(memory_estimate, st.session_state.session_id)
+                            img_pil = prepare_image(img_pil)
+                            palette = extract_palette(img_pil, num_colors, quantize_method_selected)
+                        else: palette = None # Every position already in the manifest
 
                         for pos in positions:
                             if processed_count_this_run >= current_processing_limit and is_initial_preview_phase:
@@ -549,24 +434,26 @@ try:
                                 generation_interrupted = True; time.sleep(0.5); st.rerun()
 
                             try:
-                                result_img = draw_layout(img_pil.copy(), palette, pos, image_border_thickness_percent_val, 
-                                                         swatch_separator_thickness_percent_val, individual_swatch_border_thickness_percent_val,
-                                                         border_color, swatch_border_color, swatch_size_percent_val)
-                                img_byte_arr_output = io.BytesIO()
-                                safe_base = "".join(c if c.isalnum() or c in (' ','.','_','-') else '_' for c in os.path.splitext(file_name)[0]).rstrip()
-                                output_filename = f"{safe_base}_{pos}.{extension}"
-                                save_params = {'quality': 95} if img_format == "JPEG" else ({'quality': 85, 'lossless': webp_lossless} if img_format == "WEBP" else {})
-                                if img_format == "WEBP" and webp_lossless: save_params['quality'] = 100
-
-                                result_img.save(img_byte_arr_output, format=img_format, **save_params)
-                                img_bytes_for_dl = img_byte_arr_output.getvalue()
+                                output_filename = safe_output_filename(file_name, pos, extension)
+                                if pos in resumed_records:
+                                    img_bytes_for_dl = batch_manifest.load_output(resumed_records[pos])
+                                    thumb_png = batch_manifest.load_thumbnail(resumed_records[pos])
+                                else:
+                                    result_img = render_position(img_pil, palette, pos, job_settings)
+                                    img_bytes_for_dl = encode_image(result_img, img_format, webp_lossless)
+                                    thumb_png = make_preview_thumbnail(result_img)
                                 st.session_state.generated_image_data[output_filename] = img_bytes_for_dl
                                 if is_full_batch_phase or is_small_batch_phase: zipf.writestr(output_filename, img_bytes_for_dl)
-
-                                preview_thumb = result_img.copy(); preview_thumb.thumbnail((200, 200))
-                                with io.BytesIO() as buf_disp:
-                                    preview_thumb.save(buf_disp, format="PNG")
-                                    img_b64_disp = base64.b64encode(buf_disp.getvalue()).decode("utf-8")
+                                if batch_manifest and pos not in resumed_records:
+                                    # The output is already delivered; a disk or manifest error only costs resumability
+                                    try:
+                                        batch_manifest.record_output(source_digest, file_name, pos, output_filename, img_bytes_for_dl, palette,
+                                                                     source_started_at, (time.perf_counter() - output_started) * 1000, thumb_png)
+                                    except Exception as e_manifest:
+                                        st.warning(f"Could not save `{output_filename}` to the job manifest: {e_manifest}")
+                                    source_started_at = utc_timestamp(); output_started = time.perf_counter()
+
+                                img_b64_disp = base64.b64encode(thumb_png).decode("utf-8")
                                 
                                 dl_mime = f"image/{extension}"; img_b64_dl = base64.b64encode(img_bytes_for_dl).decode("utf-8")
                                 html_item = (f"<div class='preview-item'><div class='preview-item-name' title='{output_filename}'>{shorten_filename(output_filename)}</div>"
@@ -578,17 +465,25 @@ try:
                                 if st.session_state.preview_html_parts: preview_display_area.markdown("<div id='preview-zone'>" + "\n".join(st.session_state.preview_html_parts) + "</div>", unsafe_allow_html=True)
                             except Exception as e_layout:
                                 st.error(f"Layout error for {file_name} ({pos}): {e_layout}")
+                                if batch_manifest and not batch_manifest.completed(source_digest, pos):
+                                    batch_manifest.record_failure(source_digest, file_name, [pos], 'error', f"{type(e_layout).__name__}: {e_layout}", source_started_at, (time.perf_counter() - output_started) * 1000)
+                                source_started_at = utc_timestamp(); output_started = time.perf_counter()
                                 processed_count_this_run = min(processed_count_this_run + 1, current_processing_limit)
                                 preloader_and_status_container.markdown(f"<div class='preloader-area'><div class='preloader'></div><span class='preloader-text'>Generating ({processed_count_this_run}/{current_processing_limit})... (Error)</span></div>", unsafe_allow_html=True)
                         if generation_interrupted : break 
                     except (UnidentifiedImageError, IOError) as e_pil:
                         st.warning(f"Cannot process `{file_name}`: {e_pil}. Skipped.")
+                        if batch_manifest: batch_manifest.record_failure(source_digest, file_name, [p for p in positions if not batch_manifest.completed(source_digest, p)], 'error', e_pil, source_started_at, (time.perf_counter() - output_started) * 1000)
                         processed_count_this_run = min(processed_count_this_run + len(positions), current_processing_limit)
                         preloader_and_status_container.markdown(f"<div class='preloader-area'><div class='preloader'></div><span class='preloader-text'>Generating ({processed_count_this_run}/{current_processing_limit})... (Skipped)</span></div>", unsafe_allow_html=True)
                     except Exception as e_gen:
                         st.error(f"Error with `{file_name}`: {e_gen}. Skipped.")
+                        # Decompression bombs, MemoryError and the like: still leave an audit record for each missing output
+                        if batch_manifest: batch_manifest.record_failure(source_digest, file_name, [p for p in positions if not batch_manifest.completed(source_digest, p)], 'error', f"{type(e_gen).__name__}: {e_gen}", source_started_at, (time.perf_counter() - output_started) * 1000)
                         processed_count_this_run = min(processed_count_this_run + len(positions), current_processing_limit)
                         preloader_and_status_container.markdown(f"<div class='preloader-area'><div class='preloader'></div><span class='preloader-text'>Generating ({processed_count_this_run}/{current_processing_limit})... (Error)</span></div>", unsafe_allow_html=True)
+                    finally:
+                        if memory_ticket is not None: memory_scheduler.release(memory_ticket)
 
             preloader_and_status_container.empty()
             if not generation_interrupted:
@@ -0,0 +1,280 @@
+"""Resumable batch jobs with a durable results manifest.
+
+Each job lives in its own directory, keyed by the generation settings:
+
+    <jobs_dir>/<settings key>/manifest.jsonl   one JSON record per output/failure
+    <jobs_dir>/<settings key>/outputs/         rendered images and their preview thumbnails
+
+An output is written to disk before its manifest line is appended, and each line
+is fsynced. After a crash the worst case is an orphaned file, never a manifest
+entry without its output. A restarted job skips (input digest, position) pairs
+already recorded as done, so it resumes where it stopped. The manifest also
+serves as an audit trail. Runs over different inputs with the same settings
+share a job directory; each run's ZIP holds only that run's inputs.
+
+    python batch_jobs.py ./catalog --jobs-dir ./swatch_jobs --positions left,bottom --zip catalog.zip
+"""
+from datetime import datetime, timezone
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from swatch_core import (
+    generate_swatches, is_valid_image_header, safe_output_filename, ImageDimensionsError,
+    FORMAT_MAP, POSITIONS, DEFAULT_SETTINGS, QUANT_METHOD_MAP,
+)
+
+MANIFEST_NAME = "manifest.jsonl"
+OUTPUTS_DIR = "outputs"
+
+
+def input_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def settings_key(settings):
+    """Stable across processes (unlike hash()), so a restarted job finds its directory again."""
+    settings = {**DEFAULT_SETTINGS, **settings}
+    canonical = json.dumps({k: settings[k] for k in sorted(DEFAULT_SETTINGS)}, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+def utc_timestamp():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+class BatchManifest:
+    """Append-only manifest plus output files for one settings key."""
+
+    def __init__(self, job_dir, settings):
+        self.job_dir = job_dir
+        self.settings = {**DEFAULT_SETTINGS, **settings}
+        self.settings_key = settings_key(self.settings)
+        self.path = os.path.join(job_dir, MANIFEST_NAME)
+        self.outputs_dir = os.path.join(job_dir, OUTPUTS_DIR)
+        os.makedirs(self.outputs_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._done = {}
+        self.records = []
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path): return
+        with open(self.path, encoding="utf-8") as f:
+            content = f.read()
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Torn last line from a crash mid-write
+            self.records.append(record)
+            if record.get('status') == 'done' and record.get('settings_key') == self.settings_key:
+                self._done[(record['input_digest'], record['position'])] = record
+        if content and not content.endswith("\n"):
+            # Terminate the torn line so the next append starts a fresh record
+            with open(self.path, "a", encoding="utf-8") as f: f.write("\n")
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line); f.flush(); os.fsync(f.fileno())
+            self.records.append(record)
+            if record['status'] == 'done':
+                self._done[(record['input_digest'], record['position'])] = record
+
+    def completed(self, digest, position, need_thumbnail=False):
+        """The 'done' record for this input and position, if its output file (and thumbnail, if asked) still exists."""
+        record = self._done.get((digest, position))
+        if not record or not os.path.exists(os.path.join(self.job_dir, record['output_path'])): return None
+        if need_thumbnail and not (record.get('thumbnail_path') and os.path.exists(os.path.join(self.job_dir, record['thumbnail_path']))):
+            return None
+        return record
+
+    def load_output(self, record):
+        with open(os.path.join(self.job_dir, record['output_path']), "rb") as f:
+            return f.read()
+
+    def load_thumbnail(self, record):
+        with open(os.path.join(self.job_dir, record['thumbnail_path']), "rb") as f:
+            return f.read()
+
+    def _write_file(self, relative_path, data):
+        # Unique temp name: sessions sharing this job can write the same output at once
+        fd, tmp_path = tempfile.mkstemp(dir=self.outputs_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data); f.flush(); os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.job_dir, relative_path))
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    def record_output(self, digest, source_name, position, output_filename, output_bytes, palette, started_at, duration_ms,
+                      thumbnail_bytes=None):
+        output_path = os.path.join(OUTPUTS_DIR, f"{digest[:12]}_{output_filename}")
+        self._write_file(output_path, output_bytes)
+        # Stored so a resumed output's preview needs no decode of the full canvas
+        thumbnail_path = None
+        if thumbnail_bytes is not None:
+            thumbnail_path = output_path + ".thumb.png"
+            self._write_file(thumbnail_path, thumbnail_bytes)
+        record = {
+            'status': 'done', 'input_digest': digest, 'source_name': source_name, 'position': position,
+            'settings_key': self.settings_key, 'output_name': output_filename, 'output_path': output_path,
+            'thumbnail_path': thumbnail_path,
+            'output_bytes': len(output_bytes), 'palette': ["#%02X%02X%02X" % tuple(c) for c in palette],
+            'started_at': started_at, 'finished_at': utc_timestamp(), 'duration_ms': round(duration_ms, 1),
+        }
+        self._append(record)
+        return record
+
+    def record_failure(self, digest, source_name, positions, status, error, started_at, duration_ms):
+        """Failed or skipped items are logged for the audit trail but retried on resume."""
+        for position in positions:
+            self._append({
+                'status': status, 'input_digest': digest, 'source_name': source_name, 'position': position,
+                'settings_key': self.settings_key, 'error': str(error),
+                'started_at': started_at, 'finished_at': utc_timestamp(), 'duration_ms': round(duration_ms, 1),
+            })
+
+    def summary(self):
+        """Latest status counts for every (input, position) in this job, across all runs."""
+        counts = {}
+        latest = {}
+        for record in self.records:
+            if record.get('settings_key') == self.settings_key:
+                latest[(record['input_digest'], record['position'])] = record['status']
+        for status in latest.values(): counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+def open_job(jobs_dir, settings):
+    settings = {**DEFAULT_SETTINGS, **settings}
+    return BatchManifest(os.path.join(jobs_dir, settings_key(settings)), settings)
+
+
+def run_batch(manifest, sources, positions, on_progress=None):
+    """Generate every missing (source, position) output, recording each in the manifest.
+
+    `sources` yields (name, bytes). Returns (counts, outputs): `counts` has
+    'done', 'resumed' (finished by an earlier run), 'duplicate' (same bytes as an
+    earlier source in this run) and 'failed'; `outputs` lists (ZIP entry name,
+    'done' record) for this run's sources only. Entry names come from the current
+    source, not from whichever source first produced the output. A job directory
+    is shared by every run with the same settings, so build downloads from
+    `outputs` rather than from the whole manifest.
+    """
+    _, extension = FORMAT_MAP[manifest.settings['output_format']]
+    counts = {'done': 0, 'resumed': 0, 'duplicate': 0, 'failed': 0}
+    outputs = []
+    seen = set()  # Input digests already handled in this run
+    for name, image_bytes in sources:
+        digest = input_digest(image_bytes)
+        done_records = {pos: manifest.completed(digest, pos) for pos in positions}
+        pending = [pos for pos in positions if not done_records[pos]]
+        status = 'duplicate' if digest in seen else 'resumed'
+        counts[status] += len(positions) - len(pending)
+        seen.add(digest)
+        if pending:
+            started_at = utc_timestamp(); started = time.perf_counter()
+            # generate_swatches yields in `pending` order
+            produced = 0
+            try:
+                for pos, (output_filename, output_bytes, palette, thumbnail) in zip(pending, generate_swatches(image_bytes, name, pending, manifest.settings)):
+                    now = time.perf_counter()
+                    done_records[pos] = manifest.record_output(digest, name, pos, output_filename, output_bytes, palette, started_at,
+                                                               (now - started) * 1000, thumbnail)
+                    started_at = utc_timestamp(); started = now
+                    produced += 1; counts['done'] += 1
+                status = 'done'
+            except Exception as e:
+                # Only the dimension check is a deliberate skip; anything else (bad data,
+                # decompression bombs, MemoryError) is an error, logged and retried next run
+                status = 'skipped' if isinstance(e, ImageDimensionsError) else 'error'
+                error = e if status == 'skipped' else f"{type(e).__name__}: {e}"
+                manifest.record_failure(digest, name, pending[produced:], status, error, started_at, (time.perf_counter() - started) * 1000)
+                counts['failed'] += len(pending) - produced
+        outputs.extend((safe_output_filename(name, pos, extension), done_records[pos]) for pos in positions if done_records[pos])
+        if on_progress: on_progress(name, status)
+    return counts, outputs
+
+
+# --- CLI ---
+def iter_directory_sources(input_dir, max_bytes=None):
+    """Yield (relative path, bytes) for image files, checking the header before reading the rest."""
+    for root, _, files in os.walk(input_dir):
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            with open(path, "rb") as f:
+                header = f.read(12)
+                if is_valid_image_header(header) is None: continue
+                if max_bytes is not None and os.fstat(f.fileno()).st_size > max_bytes:
+                    print(f"  skipped  {os.path.relpath(path, input_dir)} (larger than {max_bytes // (1024 * 1024)} MB)", file=sys.stderr)
+                    continue
+                image_bytes = header + f.read()
+            yield os.path.relpath(path, input_dir), image_bytes
+
+def write_zip(manifest, outputs, zip_path):
+    """ZIP (entry name, 'done' record) pairs from run_batch, as the app's download does."""
+    written = set()
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=0) as zipf:
+        for arcname, record in outputs:
+            # Two inputs can map to the same output name; keep both
+            if arcname in written: arcname = f"{record['input_digest'][:12]}_{arcname}"
+            if arcname in written: continue
+            zipf.writestr(arcname, manifest.load_output(record))
+            written.add(arcname)
+    return len(written)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resumable batch swatch generation with a results manifest")
+    parser.add_argument("input_dir", help="Directory of images (walked recursively)")
+    parser.add_argument("--jobs-dir", default="swatch_jobs", help="Where job manifests and outputs are kept")
+    parser.add_argument("--positions", default="left,bottom", help="Comma-separated swatch positions")
+    parser.add_argument("--output-format", default=DEFAULT_SETTINGS['output_format'], choices=list(FORMAT_MAP))
+    parser.add_argument("--webp-lossless", action="store_true")
+    parser.add_argument("--quant-method", default=DEFAULT_SETTINGS['quant_method'], choices=list(QUANT_METHOD_MAP))
+    parser.add_argument("--num-colors", type=int, default=DEFAULT_SETTINGS['num_colors'])
+    parser.add_argument("--swatch-size", type=float, default=DEFAULT_SETTINGS['swatch_size_percent'])
+    parser.add_argument("--image-border", type=float, default=DEFAULT_SETTINGS['image_border_percent'])
+    parser.add_argument("--swatch-separator", type=float, default=DEFAULT_SETTINGS['swatch_separator_percent'])
+    parser.add_argument("--swatch-border", type=float, default=DEFAULT_SETTINGS['individual_swatch_border_percent'])
+    parser.add_argument("--border-color", default=DEFAULT_SETTINGS['border_color'])
+    parser.add_argument("--swatch-border-color", default=DEFAULT_SETTINGS['swatch_border_color'])
+    parser.add_argument("--zip", help="Also write this run's completed outputs to a ZIP")
+    parser.add_argument("--max-file-mb", type=float, default=200.0, help="Skip input files larger than this")
+    args = parser.parse_args(argv)
+
+    positions = [p.strip() for p in args.positions.split(",") if p.strip()]
+    unknown = [p for p in positions if p not in POSITIONS]
+    if unknown: parser.error(f"Unknown position(s): {', '.join(unknown)}")
+    settings = {
+        'output_format': args.output_format, 'webp_lossless': args.webp_lossless,
+        'quant_method': args.quant_method, 'num_colors': args.num_colors,
+        'swatch_size_percent': args.swatch_size, 'image_border_percent': args.image_border,
+        'swatch_separator_percent': args.swatch_separator, 'individual_swatch_border_percent': args.swatch_border,
+        'border_color': args.border_color, 'swatch_border_color': args.swatch_border_color,
+    }
+    manifest = open_job(args.jobs_dir, settings)
+    print(f"Job {manifest.settings_key} in {manifest.job_dir}")
+
+    def on_progress(name, status):
+        if status != 'resumed': print(f"  {status:>9}  {name}")
+
+    sources = iter_directory_sources(args.input_dir, int(args.max_file_mb * 1024 * 1024))
+    counts, outputs = run_batch(manifest, sources, positions, on_progress)
+    print(f"Generated {counts['done']}, resumed {counts['resumed']}, duplicates {counts['duplicate']}, "
+          f"failed/skipped {counts['failed']}")
+    if args.zip:
+        print(f"Wrote {write_zip(manifest, outputs, args.zip)} outputs to {args.zip}")
+    totals = manifest.summary()
+    print("Job manifest (all runs): " + ", ".join(f"{status} {n}" for status, n in sorted(totals.items())))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
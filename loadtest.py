@@ -0,0 +1,278 @@
+"""Headless load test for the generation pipeline.
+
+Simulates N concurrent app sessions, each running full batches through the
+same swatch_core calls the Streamlit script makes (decode, palette, one render
+per position, encode, ZIP, preview thumbnail). Sessions are threads in one
+process, as they are under `streamlit run`. Images are synthetic, so it runs
+fully offline.
+
+    python loadtest.py --users 8 --batches 2 --mix small:30,medium:15,large:5
+    python loadtest.py --users 8 --mix giant:2,small:20 --memory-budget-mb 1500
+"""
+from collections import Counter
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import threading
+import time
+import zipfile
+import numpy as np
+from PIL import Image
+from swatch_core import (
+    extract_palette, load_image, is_within_dimensions, prepare_image, render_position, encode_image,
+    safe_output_filename, QUANT_METHOD_MAP, FORMAT_MAP, POSITIONS, DEFAULT_SETTINGS,
+)
+from memory_budget import MemoryBudgetScheduler, estimate_image_peak_bytes
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SIZE_CLASSES = {
+    'tiny': (320, 240),
+    'small': (800, 600),
+    'medium': (2000, 1500),
+    'large': (4000, 3000),
+    'giant': (10000, 7500),
+}
+
+
+# --- Synthetic inputs ---
+def make_synthetic_image(width, height, seed=0, img_format="JPEG"):
+    """Gradient plus noise, so palette extraction and compression do real work."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 3), dtype=np.uint8)
+    pixels[..., 0] = (x + rng.integers(0, 256)) % 256
+    pixels[..., 1] = (y + rng.integers(0, 256)) % 256
+    pixels[..., 2] = ((x + y) / 2 + rng.integers(0, 256)) % 256
+    pixels ^= rng.integers(0, 32, size=(height, width, 1), dtype=np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(buf, format=img_format, quality=90)
+    return buf.getvalue()
+
+def parse_mix(mix_str):
+    """'small:30,640x480:5' -> [('small', 30, (800, 600)), ('640x480', 5, (640, 480))]."""
+    mix = []
+    for part in mix_str.split(","):
+        name, _, count = part.strip().partition(":")
+        if name in SIZE_CLASSES:
+            dims = SIZE_CLASSES[name]
+        else:
+            w, _, h = name.partition("x")
+            if not (w.isdigit() and h.isdigit()):
+                raise ValueError(f"Unknown size class `{name}` (use {', '.join(SIZE_CLASSES)} or WxH)")
+            dims = (int(w), int(h))
+            if min(dims) < 1: raise ValueError(f"Size `{name}` must be at least 1x1")
+        if not (count or "1").isdigit() or int(count or 1) < 1:
+            raise ValueError(f"Count for `{name}` must be a whole number of at least 1, got `{count}`")
+        mix.append((name, int(count or 1), dims))
+    return mix
+
+def build_batch(mix, variants=3):
+    """Encode each size class once (a few variants each) and reuse the bytes across sessions."""
+    encoded = {name: [make_synthetic_image(*dims, seed=i) for i in range(variants)] for name, _, dims in mix}
+    batch = []
+    for name, count, _ in mix:
+        for i in range(count):
+            batch.append({'name': f"{name}_{i:03d}.jpg", 'bytes': encoded[name][i % variants], 'size_class': name})
+    return batch
+
+
+# --- Memory sampling ---
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss_bytes():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class RSSSampler(threading.Thread):
+    def __init__(self, interval=0.05):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.baseline = current_rss_bytes()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            rss = current_rss_bytes()
+            if rss is None: return
+            self.peak = max(self.peak, rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set(); self.join()
+
+
+# --- Simulated session ---
+def run_session_batch(sources, positions, settings, record, scheduler=None, session_id=None):
+    """One full-batch run, mirroring the app's generation loop.
+
+    Calls record(kind, size_class, seconds, admission_wait_seconds, error) per image,
+    where error is "ExceptionType: message" for failed images and the admission
+    wait is None unless the image was admitted by the scheduler.
+    With a scheduler, each image is admitted against the memory budget first.
+    """
+    img_format, extension = FORMAT_MAP[settings['output_format']]
+    generated_image_data = {}; preview_html_parts = []
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, compresslevel=0) as zipf:
+        for source_item in sources:
+            started = time.perf_counter()
+            memory_ticket = None; admission_wait = None
+            try:
+                img_pil = load_image(source_item['bytes'])
+                if not is_within_dimensions(*img_pil.size):
+                    record('skipped', source_item['size_class'], time.perf_counter() - started, None, None); continue
+                if scheduler is not None:
+                    memory_estimate = estimate_image_peak_bytes(*img_pil.size, img_pil.mode, positions, settings)
+                    wait_started = time.perf_counter()
+                    memory_ticket = scheduler.acquire(memory_estimate, session_id)
+                    admission_wait = time.perf_counter() - wait_started
+                img_pil = prepare_image(img_pil)
+                palette = extract_palette(img_pil, settings['num_colors'], QUANT_METHOD_MAP[settings['quant_method']])
+                for pos in positions:
+                    result_img = render_position(img_pil, palette, pos, settings)
+                    output_filename = safe_output_filename(source_item['name'], pos, extension)
+                    img_bytes_for_dl = encode_image(result_img, img_format, settings['webp_lossless'])
+                    generated_image_data[output_filename] = img_bytes_for_dl
+                    zipf.writestr(output_filename, img_bytes_for_dl)
+                    preview_thumb = result_img.copy(); preview_thumb.thumbnail((200, 200))
+                    with io.BytesIO() as buf_disp:
+                        preview_thumb.save(buf_disp, format="PNG")
+                        preview_html_parts.append(base64.b64encode(buf_disp.getvalue()) + base64.b64encode(img_bytes_for_dl))
+                record('ok', source_item['size_class'], time.perf_counter() - started, admission_wait, None)
+            except Exception as e:
+                record('error', source_item['size_class'], time.perf_counter() - started, admission_wait, f"{type(e).__name__}: {e}")
+            finally:
+                if memory_ticket is not None: scheduler.release(memory_ticket)
+    return zip_buffer.getbuffer().nbytes
+
+def percentile(sorted_values, pct):
+    if not sorted_values: return None
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k); hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def run_load_test(users, batches_per_user, mix, positions, settings=None, ramp_up=0.0, variants=3, scheduler=None,
+                  top_errors=5):
+    """Run the sessions and return a report dict; `mix` comes from parse_mix()."""
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    sources = build_batch(mix, variants)
+    results = []; results_lock = threading.Lock()
+
+    def record(kind, size_class, seconds, admission_wait, error):
+        with results_lock: results.append((kind, size_class, seconds, admission_wait, error))
+
+    def session(user_index):
+        if ramp_up and users > 1: time.sleep(ramp_up * user_index / (users - 1))
+        for _ in range(batches_per_user):
+            run_session_batch(sources, positions, settings, record, scheduler, f"session-{user_index}")
+
+    sampler = RSSSampler(); sampler.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(i,), name=f"session-{i}") for i in range(users)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+
+    latencies = sorted(s for kind, _, s, _, _ in results if kind == 'ok')
+    admission_waits = sorted(w for _, _, _, w, _ in results if w is not None)
+    error_counts = Counter(e for kind, _, _, _, e in results if kind == 'error')
+    per_class = {}
+    for name, _, _ in mix:
+        class_lat = sorted(s for kind, c, s, _, _ in results if kind == 'ok' and c == name)
+        per_class[name] = {'images': len(class_lat), 'p50_s': percentile(class_lat, 50), 'p95_s': percentile(class_lat, 95)}
+    errors = sum(1 for kind, *_ in results if kind == 'error')
+    skipped = sum(1 for kind, *_ in results if kind == 'skipped')
+    return {
+        'users': users, 'batches_per_user': batches_per_user, 'batch_size': len(sources),
+        'positions': list(positions), 'elapsed_s': elapsed,
+        'images': len(results), 'images_ok': len(latencies), 'errors': errors, 'skipped': skipped,
+        'error_rate': errors / len(results) if results else 0.0,
+        'top_errors': [{'error': e, 'count': n} for e, n in error_counts.most_common(top_errors)],
+        'images_per_s': len(latencies) / elapsed if elapsed else 0.0,
+        'generations_per_s': len(latencies) * len(positions) / elapsed if elapsed else 0.0,
+        'latency_s': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                      'p99': percentile(latencies, 99), 'max': latencies[-1] if latencies else None},
+        'per_size_class': per_class,
+        'admission_wait_s': {'p50': percentile(admission_waits, 50), 'p95': percentile(admission_waits, 95),
+                             'total': sum(admission_waits)},
+        'memory_scheduler': scheduler.snapshot() if scheduler is not None else None,
+        'rss_baseline_bytes': sampler.baseline, 'rss_peak_sampled_bytes': sampler.peak or None,
+        'rss_peak_bytes': peak_rss_bytes(),
+    }
+
+
+def _fmt_s(v): return "-" if v is None else f"{v * 1000:.0f} ms"
+def _fmt_mb(v): return "-" if v is None else f"{v / (1024 * 1024):.0f} MB"
+
+def print_report(report):
+    print(f"Sessions: {report['users']} x {report['batches_per_user']} batch(es) of {report['batch_size']} images, "
+          f"positions: {', '.join(report['positions'])}")
+    print(f"Elapsed: {report['elapsed_s']:.1f} s   Throughput: {report['images_per_s']:.2f} images/s "
+          f"({report['generations_per_s']:.2f} generations/s)")
+    lat = report['latency_s']
+    print(f"Per-image latency: p50 {_fmt_s(lat['p50'])}  p95 {_fmt_s(lat['p95'])}  p99 {_fmt_s(lat['p99'])}  max {_fmt_s(lat['max'])}")
+    for name, stats in report['per_size_class'].items():
+        print(f"  {name:>8}: {stats['images']:5d} images  p50 {_fmt_s(stats['p50_s'])}  p95 {_fmt_s(stats['p95_s'])}")
+    print(f"Errors: {report['errors']} ({report['error_rate']:.1%})   Skipped: {report['skipped']}")
+    for entry in report['top_errors']:
+        print(f"  {entry['count']:5d} x {entry['error']}")
+    if report['memory_scheduler']:
+        wait = report['admission_wait_s']; mem = report['memory_scheduler']
+        print(f"Memory budget: {_fmt_mb(mem['budget_bytes'])} (session {_fmt_mb(mem['session_budget_bytes'])})  "
+              f"peak admitted {_fmt_mb(mem['peak_in_use_bytes'])}  admission wait p95 {_fmt_s(wait['p95'])}")
+    print(f"RSS: baseline {_fmt_mb(report['rss_baseline_bytes'])}  peak during run {_fmt_mb(report['rss_peak_sampled_bytes'])}  "
+          f"process peak {_fmt_mb(report['rss_peak_bytes'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless load test for the swatch generation pipeline")
+    parser.add_argument("--users", type=int, default=4, help="Concurrent simulated sessions")
+    parser.add_argument("--batches", type=int, default=1, help="Full batches per session")
+    parser.add_argument("--mix", default="small:30,medium:15,large:5",
+                        help=f"Batch mix as class:count pairs; classes: {', '.join(SIZE_CLASSES)} or WxH")
+    parser.add_argument("--positions", default="left,bottom", help="Comma-separated swatch positions")
+    parser.add_argument("--output-format", default=DEFAULT_SETTINGS['output_format'], choices=list(FORMAT_MAP))
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="Seconds over which sessions start")
+    parser.add_argument("--memory-budget-mb", type=float, help="Admit images through a memory-budget scheduler")
+    parser.add_argument("--session-budget-mb", type=float, help="Per-session cap (default: half the budget)")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    positions = [p.strip() for p in args.positions.split(",") if p.strip()]
+    unknown = [p for p in positions if p not in POSITIONS]
+    if unknown: parser.error(f"Unknown position(s): {', '.join(unknown)}")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    scheduler = None
+    if args.memory_budget_mb:
+        session_mb = args.session_budget_mb or args.memory_budget_mb / 2
+        scheduler = MemoryBudgetScheduler(int(args.memory_budget_mb * 1024 * 1024), int(session_mb * 1024 * 1024))
+    report = run_load_test(args.users, args.batches, mix, positions,
+                           settings={'output_format': args.output_format}, ramp_up=args.ramp_up, scheduler=scheduler)
+    if args.json: print(json.dumps(report, indent=2))
+    else: print_report(report)
+    return 1 if report['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Memory-budget admission for image work.
+
+Estimates an image's peak memory from its header (no pixel decode) and only
+admits work while the total stays inside a budget. Images whose estimate alone
+exceeds the budget ("giants") run with nothing else admitted. Admission is fair
+across sessions, and a per-session cap stops one session's batch from taking
+the whole budget.
+
+The app and server.py use the process-wide scheduler from
+get_default_scheduler(), configured with SWATCH_MEMORY_BUDGET_MB and
+SWATCH_SESSION_BUDGET_MB (server.py can override it with --memory-budget-mb).
+loadtest.py builds its own scheduler when given --memory-budget-mb. The app
+still processes a session's images one at a time, so small images only run in
+parallel across sessions, or within one client through server.py's pool.
+"""
+import collections
+from PIL import Image
+import io
+import itertools
+import os
+import threading
+import time
+from swatch_core import DEFAULT_SETTINGS
+
+DEFAULT_BUDGET_MB = 2048
+# Multi-byte modes that getmodebands() would undercount
+_MODE_BYTES_PER_PIXEL = {'1': 1, 'I': 4, 'F': 4, 'I;16': 2, 'I;16B': 2, 'I;16L': 2, 'RGBa': 4, 'LA': 2}
+# Rough encoded size as a fraction of the raw canvas
+_ENCODED_RATIO = {'PNG': 0.5, 'JPG': 0.125, 'WEBP': 0.125}
+
+
+class MemoryBudgetTimeout(Exception):
+    pass
+
+
+# --- Estimation ---
+def _bytes_per_pixel(mode):
+    if mode in _MODE_BYTES_PER_PIXEL: return _MODE_BYTES_PER_PIXEL[mode]
+    try: return Image.getmodebands(mode)
+    except (KeyError, ValueError): return 4
+
+def _canvas_size(width, height, position, settings):
+    # Mirrors the sizing arithmetic in draw_layout
+    shorter = min(width, height)
+    border = int(shorter * settings['image_border_percent'] / 100)
+    if settings['image_border_percent'] > 0 and border == 0: border = 1
+    separator = int(shorter * settings['swatch_separator_percent'] / 100)
+    if settings['swatch_separator_percent'] > 0 and separator == 0: separator = 1
+    swatch = max(int(shorter * settings['swatch_size_percent'] / 100), 1 if settings['swatch_size_percent'] > 0 else 0)
+    add = swatch + separator
+    if position in ('top', 'bottom'): return width + 2 * border, height + 2 * border + add
+    return width + 2 * border + add, height + 2 * border
+
+def estimate_image_peak_bytes(width, height, mode, positions=(), settings=None):
+    """Estimate peak bytes to process one image the way the app does.
+
+    Counts the decoded image, the RGB working copy, extract_palette's RGB copy
+    and quantized image, and for each position the image copy, the canvas, the
+    encode buffer and the preview thumbnail source. Encoded outputs stay in
+    memory (image data, ZIP, base64 preview), so they accumulate across positions.
+    """
+    settings = {**DEFAULT_SETTINGS, **(settings or {})}
+    pixels = width * height
+    decoded = pixels * _bytes_per_pixel(mode)
+    working = decoded if mode in ("RGB", "L") else pixels * 3
+    prepare_peak = decoded + working if mode not in ("RGB", "L") else decoded
+    palette_peak = working + pixels * 3 + pixels
+
+    render_peak = 0; retained = 0
+    encoded_ratio = _ENCODED_RATIO.get(settings['output_format'], 0.5)
+    if settings['output_format'] == "WEBP" and settings['webp_lossless']: encoded_ratio = 0.5
+    for pos in positions:
+        canvas_w, canvas_h = _canvas_size(width, height, pos, settings)
+        canvas = canvas_w * canvas_h * 3
+        render_peak = max(render_peak, working * 2 + canvas * 3 + retained)
+        retained += int(canvas * encoded_ratio * 3)
+    return max(prepare_peak, palette_peak, render_peak, working + retained)
+
+def estimate_from_bytes(image_bytes, positions=(), settings=None):
+    """Header-only estimate; returns 0 for bytes PIL cannot identify (they fail fast on decode anyway)."""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            width, height = img.size
+            mode = img.mode
+    except Exception:
+        return 0
+    return estimate_image_peak_bytes(width, height, mode, positions, settings)
+
+
+# --- Scheduler ---
+class _Waiter:
+    __slots__ = ('cost', 'session_id', 'is_giant', 'ticket')
+
+    def __init__(self, cost, session_id, is_giant):
+        self.cost = cost
+        self.session_id = session_id
+        self.is_giant = is_giant
+        self.ticket = None
+
+
+class MemoryBudgetScheduler:
+    """Admit work while the summed estimates stay within `budget_bytes`, fairly across sessions.
+
+    Each session's work is admitted in arrival order. Between sessions, the
+    next admission goes to the waiting session that has been charged the fewest
+    bytes so far. This is start-time fair queuing: a session that starts waiting
+    is lifted to the charge of the latest admission, so idle time earns no
+    credit. If that session's next item does not fit, capacity is held for it
+    rather than handed to sessions that have already had more. A giant (estimate
+    above the whole budget) is charged its full size, so its session goes to the
+    back of the line for its next one.
+
+    A session's running total may not exceed `session_budget_bytes`; a single
+    item larger than the cap runs only when its session has nothing else running.
+    """
+
+    def __init__(self, budget_bytes, session_budget_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.session_budget_bytes = session_budget_bytes
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.session_in_use = {}
+        self._running_giant = False
+        self._tickets = itertools.count(1)
+        self._active = {}
+        self._queues = {}  # session_id -> deque of waiting _Waiter
+        self._charged = {}  # session_id -> bytes admitted so far
+        self._virtual_time = 0  # Charge of the most recently admitted session before its admission
+        self._arrival = itertools.count()
+        self._order = {}  # session_id -> arrival sequence, breaks ties between equal charges
+        self._cond = threading.Condition()
+
+    @property
+    def waiting(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def _fits_budget(self, waiter):
+        if self._running_giant: return False
+        if waiter.is_giant: return self.in_use == 0
+        return self.in_use + waiter.cost <= self.budget_bytes
+
+    def _fits_session(self, waiter):
+        session_used = self.session_in_use.get(waiter.session_id, 0)
+        if self.session_budget_bytes is None or session_used == 0: return True
+        return session_used + waiter.cost <= self.session_budget_bytes
+
+    def _grant(self):
+        """Admit as many queue heads as fit, least-charged session first."""
+        while True:
+            candidates = sorted(self._queues, key=lambda s: (self._charged[s], self._order[s]))
+            granted = False
+            for session_id in candidates:
+                waiter = self._queues[session_id][0]
+                if not self._fits_session(waiter): continue  # Only this session's own cap is in the way
+                if not self._fits_budget(waiter): break  # Hold capacity for the most deserving session
+                self._admit(waiter)
+                granted = True
+                break
+            if not granted: return
+
+    def _admit(self, waiter):
+        queue_ = self._queues[waiter.session_id]
+        queue_.popleft()
+        if not queue_: del self._queues[waiter.session_id]
+        waiter.ticket = next(self._tickets)
+        self._active[waiter.ticket] = waiter
+        self.in_use += waiter.cost
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        self.session_in_use[waiter.session_id] = self.session_in_use.get(waiter.session_id, 0) + waiter.cost
+        self._virtual_time = max(self._virtual_time, self._charged[waiter.session_id])
+        self._charged[waiter.session_id] += max(waiter.cost, 1)
+        if waiter.is_giant: self._running_giant = True
+        self._cond.notify_all()
+
+    def _is_idle(self, session_id):
+        return session_id not in self._queues and session_id not in self.session_in_use
+
+    def _prune_idle(self):
+        # Idle sessions at or below the virtual time would be lifted to it anyway on return
+        for session_id in [s for s, c in self._charged.items() if c <= self._virtual_time and self._is_idle(s)]:
+            del self._charged[session_id]; self._order.pop(session_id, None)
+
+    def acquire(self, estimate_bytes, session_id=None, timeout=None):
+        """Block until admitted; returns a ticket for release(). Returns None if `timeout` expires."""
+        cost = max(0, int(estimate_bytes))
+        waiter = _Waiter(cost, session_id, cost > self.budget_bytes)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            if self._is_idle(session_id):
+                self._charged[session_id] = max(self._charged.get(session_id, 0), self._virtual_time)
+                self._order.setdefault(session_id, next(self._arrival))
+            self._queues.setdefault(session_id, collections.deque()).append(waiter)
+            self._grant()
+            while waiter.ticket is None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    queue_ = self._queues[session_id]
+                    queue_.remove(waiter)
+                    if not queue_: del self._queues[session_id]
+                    # Capacity held for this waiter can now go to someone else
+                    self._grant()
+                    return None
+                self._cond.wait(remaining)
+            return waiter.ticket
+
+    def release(self, ticket):
+        with self._cond:
+            waiter = self._active.pop(ticket)
+            self.in_use -= waiter.cost
+            remaining = self.session_in_use.get(waiter.session_id, 0) - waiter.cost
+            if remaining > 0: self.session_in_use[waiter.session_id] = remaining
+            else: self.session_in_use.pop(waiter.session_id, None)
+            if waiter.is_giant: self._running_giant = False
+            self._grant()
+            self._prune_idle()
+
+    def snapshot(self):
+        with self._cond:
+            return {'budget_bytes': self.budget_bytes, 'session_budget_bytes': self.session_budget_bytes,
+                    'in_use_bytes': self.in_use, 'peak_in_use_bytes': self.peak_in_use,
+                    'waiting': self.waiting, 'waiting_sessions': len(self._queues),
+                    'running': len(self._active), 'running_giant': self._running_giant}
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+def get_default_scheduler():
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            budget_mb = float(os.environ.get("SWATCH_MEMORY_BUDGET_MB", DEFAULT_BUDGET_MB))
+            session_mb = os.environ.get("SWATCH_SESSION_BUDGET_MB")
+            session_bytes = int(float(session_mb) * 1024 * 1024) if session_mb else int(budget_mb * 1024 * 1024 / 2)
+            _default_scheduler = MemoryBudgetScheduler(int(budget_mb * 1024 * 1024), session_bytes)
+        return _default_scheduler
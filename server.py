@@ -0,0 +1,445 @@
+"""Standalone HTTP service for palette extraction and swatch rendering.
+
+Runs the same functions as app.py (via swatch_core), so results match the UI.
+
+    python server.py --port 8502 --workers 4
+
+Endpoints (body is raw image bytes, or JSON {"url": "https://..."}):
+    POST /palette?num_colors=6&quant_method=MEDIANCUT          -> JSON palette
+    POST /render?position=bottom&output_format=PNG&...         -> rendered image
+    GET  /health                                               -> queue and memory stats
+
+Each job is admitted against the shared memory budget (see memory_budget.py)
+before it is queued; send X-Session-Id to get a per-client session cap,
+otherwise the client address is used.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import hashlib
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import requests
+from PIL import Image, UnidentifiedImageError
+from swatch_core import (
+    extract_palette, load_image, is_within_dimensions, prepare_image, render_position, encode_image,
+    fetch_image_url, ImageTooLargeError, QUANT_METHOD_MAP, FORMAT_MAP, POSITIONS, DEFAULT_SETTINGS, SETTING_RANGES,
+    MAX_URL_BYTES,
+)
+from memory_budget import DEFAULT_BUDGET_MB, MemoryBudgetScheduler, MemoryBudgetTimeout, estimate_from_bytes, get_default_scheduler
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class BadRequestError(Exception):
+    pass
+
+
+# --- Worker functions (run in the process pool) ---
+def _decode_for_palette(image_bytes):
+    img_pil = load_image(image_bytes)
+    w, h = img_pil.size
+    if not is_within_dimensions(w, h):
+        raise ValueError(f"Image ({w}x{h}) outside dimensions.")
+    return prepare_image(img_pil)
+
+def palette_batch_worker(items):
+    """Extract palettes for a micro-batch of (image_bytes, num_colors, quant_method) items.
+
+    Returns one ('ok', palette), ('too_large', message), ('error', message) or
+    ('failed', message) per item, so one bad image does not fail the whole batch.
+    """
+    results = []
+    for image_bytes, num_colors, quant_method in items:
+        try:
+            img_pil = _decode_for_palette(image_bytes)
+            results.append(('ok', extract_palette(img_pil, num_colors, QUANT_METHOD_MAP[quant_method])))
+        except Image.DecompressionBombError as e:
+            results.append(('too_large', str(e)))
+        except (UnidentifiedImageError, IOError, ValueError) as e:
+            results.append(('error', str(e)))
+        except Exception as e:
+            results.append(('failed', f"{type(e).__name__}: {e}"))
+    return results
+
+def _worker_error(status, message):
+    if status == 'too_large': return ImageTooLargeError(message)
+    if status == 'error': return BadRequestError(message)
+    return RuntimeError(message)
+
+def render_worker(image_bytes, position, settings):
+    img_format, extension = FORMAT_MAP[settings['output_format']]
+    img_pil = _decode_for_palette(image_bytes)
+    palette = extract_palette(img_pil, settings['num_colors'], QUANT_METHOD_MAP[settings['quant_method']])
+    result_img = render_position(img_pil, palette, position, settings)
+    return encode_image(result_img, img_format, settings['webp_lossless']), f"image/{extension}", palette
+
+
+# --- Job dispatch ---
+class SwatchService:
+    """Bounded job queue in front of a process pool.
+
+    Requests are rejected with QueueFullError once `queue_size` jobs are waiting.
+    The dispatcher only hands work to the pool while fewer than `max_in_flight`
+    calls are running, so a busy pool fills the queue instead of hiding work in
+    the executor's own unbounded queue. Palette jobs that arrive within
+    `batch_wait` seconds of each other are grouped (up to `batch_size`), identical
+    inputs in a batch are only computed once, and the batch is split into at most
+    `workers` pool calls so it runs on every worker rather than one.
+
+    Before a job is queued it must be admitted by the memory scheduler; its
+    budget is held until the pool call finishes, even if the client gave up.
+    At most `max_admission_waiters` requests (default `queue_size`) may wait for
+    admission at once; beyond that they get QueueFullError too, so waiting
+    handler threads and their request bodies stay bounded. URL jobs hold one of
+    these slots while downloading, so fetches get the same backpressure.
+
+    If a worker dies (e.g. OOM-killed) the pool breaks: the affected jobs fail
+    and the pool is replaced, so later requests are served again. Workers are
+    spawned rather than forked, since the pool starts them while other threads run.
+    """
+
+    def __init__(self, workers=2, queue_size=64, batch_size=16, batch_wait=0.01, max_in_flight=None,
+                 scheduler=None, admit_timeout=30.0, max_admission_waiters=None):
+        self.scheduler = scheduler or get_default_scheduler()
+        self.admit_timeout = admit_timeout
+        self.admission_slots = threading.BoundedSemaphore(max_admission_waiters or queue_size)
+        self.workers = workers
+        self.executor = self._new_executor()
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.in_flight = threading.BoundedSemaphore(max_in_flight or workers * 2)
+        self.stats = {'accepted': 0, 'rejected': 0, 'palette_batches': 0, 'palette_jobs': 0, 'render_jobs': 0,
+                      'pool_restarts': 0}
+        self._stats_lock = threading.Lock()
+        self._executor_lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="swatch-dispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def _count(self, key, n=1):
+        with self._stats_lock: self.stats[key] += n
+
+    def _new_executor(self):
+        # Forking a process with running threads can deadlock the child
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _take_admission_slot(self):
+        # Fail fast rather than wait for memory only to find the queue full
+        if self.jobs.full() or not self.admission_slots.acquire(blocking=False):
+            self._count('rejected')
+            raise QueueFullError("Server busy, retry later.")
+
+    def fetch_url(self, url):
+        """fetch_image_url() while holding an admission slot; raises QueueFullError when busy."""
+        self._take_admission_slot()
+        try:
+            return fetch_image_url(url)
+        finally:
+            self.admission_slots.release()
+
+    def _submit(self, kind, payload, memory_estimate, session_id):
+        self._take_admission_slot()
+        try:
+            ticket = self.scheduler.acquire(memory_estimate, session_id, timeout=self.admit_timeout)
+        finally:
+            self.admission_slots.release()
+        if ticket is None:
+            self._count('rejected')
+            raise MemoryBudgetTimeout("Server memory budget exhausted, retry later.")
+        future = Future()
+        try:
+            self.jobs.put_nowait((kind, payload, future))
+        except queue.Full:
+            self.scheduler.release(ticket)
+            self._count('rejected')
+            raise QueueFullError("Server busy, retry later.")
+        future.add_done_callback(lambda _: self.scheduler.release(ticket))
+        self._count('accepted')
+        return future
+
+    def submit_palette(self, image_bytes, num_colors, quant_method, session_id=None):
+        memory_estimate = estimate_from_bytes(image_bytes)
+        return self._submit('palette', (image_bytes, num_colors, quant_method), memory_estimate, session_id)
+
+    def submit_render(self, image_bytes, position, settings, session_id=None):
+        memory_estimate = estimate_from_bytes(image_bytes, (position,), settings)
+        return self._submit('render', (image_bytes, position, settings), memory_estimate, session_id)
+
+    def _collect_palette_batch(self, first):
+        batch = [first]
+        deferred = []
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try:
+                job = self.jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None or job[0] != 'palette':
+                deferred.append(job)
+                if job is None: break
+            else:
+                batch.append(job)
+        return batch, deferred
+
+    def _replace_executor(self, broken):
+        with self._executor_lock:
+            if self.executor is not broken: return  # Already replaced by another callback
+            self.executor = self._new_executor()
+        self._count('pool_restarts')
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _run_in_pool(self, fn, *args, on_done):
+        self.in_flight.acquire()
+        executor = self.executor
+        try:
+            try:
+                pool_future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # The pool broke since the last job finished; retry once on a fresh one
+                self._replace_executor(executor)
+                executor = self.executor
+                pool_future = executor.submit(fn, *args)
+        except Exception as e:
+            self.in_flight.release()
+            if isinstance(e, BrokenProcessPool): self._replace_executor(executor)
+            failed = Future(); failed.set_exception(e)
+            on_done(failed)
+            return
+        def _release(f):
+            self.in_flight.release()
+            if f.cancelled():
+                # Pending calls are cancelled on shutdown or pool replacement; f.exception() would raise
+                f = Future(); f.set_exception(RuntimeError("Pool call was cancelled."))
+            elif isinstance(f.exception(), BrokenProcessPool): self._replace_executor(executor)
+            on_done(f)
+        pool_future.add_done_callback(_release)
+
+    def _dispatch_palette_batch(self, batch):
+        self._count('palette_batches'); self._count('palette_jobs', len(batch))
+        unique = {}
+        for _, payload, future in batch:
+            key = (hashlib.sha256(payload[0]).digest(), payload[1], payload[2])
+            unique.setdefault(key, (payload, []))[1].append(future)
+        groups = list(unique.values())
+        # One pool call per worker at most, so a burst is spread over the whole pool
+        chunk_size = -(-len(groups) // self.workers)
+        for start in range(0, len(groups), chunk_size):
+            self._dispatch_palette_chunk(groups[start:start + chunk_size])
+
+    def _dispatch_palette_chunk(self, groups):
+        def _on_done(pool_future):
+            try:
+                results = pool_future.result()
+            except Exception as e:
+                for _, futures in groups:
+                    for f in futures: f.set_exception(e)
+                return
+            for (_, futures), (status, value) in zip(groups, results):
+                for f in futures:
+                    if status == 'ok': f.set_result(value)
+                    else: f.set_exception(_worker_error(status, value))
+        self._run_in_pool(palette_batch_worker, [payload for payload, _ in groups], on_done=_on_done)
+
+    def _dispatch_render(self, payload, future):
+        self._count('render_jobs')
+        def _on_done(pool_future):
+            try: future.set_result(pool_future.result())
+            except Image.DecompressionBombError as e: future.set_exception(ImageTooLargeError(str(e)))
+            except (UnidentifiedImageError, IOError, ValueError) as e: future.set_exception(BadRequestError(str(e)))
+            except Exception as e: future.set_exception(e)
+        self._run_in_pool(render_worker, *payload, on_done=_on_done)
+
+    def _dispatch_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None: return
+            jobs = [job]
+            try:
+                if job[0] == 'palette':
+                    batch, deferred = self._collect_palette_batch(job)
+                    jobs = batch + deferred
+                    self._dispatch_palette_batch(batch)
+                    for deferred_job in deferred:
+                        if deferred_job is None: return
+                        self._dispatch_render(deferred_job[1], deferred_job[2])
+                else:
+                    self._dispatch_render(job[1], job[2])
+            except Exception as e:
+                # Never let one bad dispatch stop the loop; fail whatever is still unresolved
+                for failed_job in jobs:
+                    if failed_job is not None and not failed_job[2].done(): failed_job[2].set_exception(e)
+
+    def is_healthy(self):
+        return self._dispatcher.is_alive()
+
+    def shutdown(self):
+        # Blocking put: the sentinel must get through even when the queue is full
+        self.jobs.put(None)
+        self._dispatcher.join(timeout=5)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        while True:
+            try: job = self.jobs.get_nowait()
+            except queue.Empty: break
+            if job is not None and not job[2].done(): job[2].set_exception(RuntimeError("Server shutting down."))
+
+
+# --- Request parsing ---
+def parse_settings(query):
+    settings = dict(DEFAULT_SETTINGS)
+    def _get(name): return query.get(name, [None])[0]
+    try:
+        for key, default in DEFAULT_SETTINGS.items():
+            raw = _get(key)
+            if raw is None: continue
+            if isinstance(default, bool): settings[key] = raw.lower() in ("1", "true", "yes")
+            elif isinstance(default, int): settings[key] = int(raw)
+            elif isinstance(default, float): settings[key] = float(raw)
+            else: settings[key] = raw
+    except ValueError as e:
+        raise BadRequestError(f"Invalid parameter: {e}")
+    settings['output_format'] = settings['output_format'].upper()
+    settings['quant_method'] = settings['quant_method'].upper()
+    if settings['output_format'] not in FORMAT_MAP: raise BadRequestError(f"output_format must be one of {list(FORMAT_MAP)}")
+    if settings['quant_method'] not in QUANT_METHOD_MAP: raise BadRequestError(f"quant_method must be one of {list(QUANT_METHOD_MAP)}")
+    for key, (low, high) in SETTING_RANGES.items():
+        if not low <= settings[key] <= high: raise BadRequestError(f"{key} must be between {low} and {high}")
+    return settings
+
+
+class SwatchRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive between requests; every response sets Content-Length
+    protocol_version = "HTTP/1.1"
+    server_version = "SwatchBatch/1.0"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def _send(self, status, body, content_type, extra_headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, payload, extra_headers=None):
+        self._send(status, json.dumps(payload).encode("utf-8"), "application/json", extra_headers)
+
+    def _read_body(self):
+        """Consume the whole body up front, so no early error leaves image bytes on a kept-alive connection."""
+        try: length = int(self.headers.get("Content-Length", 0))
+        except ValueError: length = -1
+        if length < 0 or length > MAX_URL_BYTES:
+            # The body is left unread, so this connection can't be reused
+            self.close_connection = True
+            if length < 0: raise BadRequestError("Invalid Content-Length.")
+            raise ImageTooLargeError("Request body is too large (>20MB).")
+        return self.rfile.read(length) if length else b""
+
+    def _resolve_image_bytes(self, body):
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try: url = json.loads(body or b"{}").get("url")
+            except (ValueError, AttributeError): raise BadRequestError("Invalid JSON body.")
+            if not url: raise BadRequestError("JSON body must contain 'url'.")
+            fetched = self.service.fetch_url(url)
+            if not fetched: raise BadRequestError("Could not validate image from URL.")
+            return fetched[1]
+        if not body: raise BadRequestError("Empty request body.")
+        return body
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/health":
+            return self._send_json(404, {"error": "Not found"})
+        healthy = self.service.is_healthy()
+        self._send_json(200 if healthy else 503, {"status": "ok" if healthy else "dispatcher stopped",
+                                                  "queued": self.service.jobs.qsize(), **self.service.stats,
+                                                  "memory": self.service.scheduler.snapshot()})
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        try:
+            body = self._read_body()
+            if parsed.path not in ("/palette", "/render"):
+                return self._send_json(404, {"error": "Not found"})
+            settings = parse_settings(query)
+            position = query.get("position", ["bottom"])[0]
+            if parsed.path == "/render" and position not in POSITIONS:
+                raise BadRequestError(f"position must be one of {list(POSITIONS)}")
+            image_bytes = self._resolve_image_bytes(body)
+            session_id = self.headers.get("X-Session-Id") or self.client_address[0]
+            if parsed.path == "/palette":
+                future = self.service.submit_palette(image_bytes, settings['num_colors'], settings['quant_method'], session_id)
+                palette = future.result(timeout=self.server.request_timeout)
+                return self._send_json(200, {
+                    "palette": [list(c) for c in palette],
+                    "hex": ["#%02X%02X%02X" % tuple(c) for c in palette],
+                })
+            future = self.service.submit_render(image_bytes, position, settings, session_id)
+            output_bytes, mime, palette = future.result(timeout=self.server.request_timeout)
+            self._send(200, output_bytes, mime, {"X-Palette": ",".join("#%02X%02X%02X" % tuple(c) for c in palette)})
+        except QueueFullError as e: self._send_json(429, {"error": str(e)}, {"Retry-After": "1"})
+        except MemoryBudgetTimeout as e: self._send_json(503, {"error": str(e)}, {"Retry-After": "5"})
+        except BadRequestError as e: self._send_json(400, {"error": str(e)})
+        except ImageTooLargeError as e:
+            self._send_json(413, {"error": str(e)}, {"Connection": "close"} if self.close_connection else None)
+        except requests.exceptions.RequestException as e: self._send_json(502, {"error": f"Error fetching URL: {e}"})
+        except FutureTimeoutError: self._send_json(504, {"error": "Processing timed out."})
+        except Exception as e: self._send_json(500, {"error": f"Internal error: {e}"})
+
+
+class SwatchHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service, request_timeout=60):
+        super().__init__(address, SwatchRequestHandler)
+        self.service = service
+        self.request_timeout = request_timeout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SwatchBatch HTTP palette/render service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--workers", type=int, default=2, help="Process pool size")
+    parser.add_argument("--queue-size", type=int, default=64, help="Waiting jobs before answering 429")
+    parser.add_argument("--batch-size", type=int, default=16, help="Max palette jobs grouped per dispatch (split across workers)")
+    parser.add_argument("--batch-wait-ms", type=float, default=10.0, help="How long to wait to fill a palette batch")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-request processing timeout (s)")
+    parser.add_argument("--memory-budget-mb", type=float, help="Memory budget for admitted jobs (default: SWATCH_MEMORY_BUDGET_MB or 2048)")
+    parser.add_argument("--session-budget-mb", type=float, help="Per-session share of the budget (default: half)")
+    parser.add_argument("--admit-timeout", type=float, default=10.0, help="Max wait for memory admission before 503 (s)")
+    args = parser.parse_args(argv)
+
+    scheduler = None
+    if args.memory_budget_mb or args.session_budget_mb:
+        budget_mb = args.memory_budget_mb or DEFAULT_BUDGET_MB
+        session_mb = args.session_budget_mb or budget_mb / 2
+        scheduler = MemoryBudgetScheduler(int(budget_mb * 1024 * 1024), int(session_mb * 1024 * 1024))
+    service = SwatchService(workers=args.workers, queue_size=args.queue_size,
+                            batch_size=args.batch_size, batch_wait=args.batch_wait_ms / 1000.0,
+                            scheduler=scheduler, admit_timeout=args.admit_timeout)
+    httpd = SwatchHTTPServer((args.host, args.port), service, request_timeout=args.timeout)
+    print(f"Serving on http://{args.host}:{args.port} ({args.workers} workers)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Image and palette functions shared by the Streamlit app and the HTTP service.
+
+Nothing in here touches Streamlit, so the same code paths can run headless.
+"""
+from PIL import Image, ImageDraw
+import io
+import os
+import requests
+
+MIN_IMAGE_DIM = 10
+MAX_IMAGE_DIM = 15000
+MAX_URL_BYTES = 20 * 1024 * 1024
+
+QUANT_METHOD_MAP = {"MEDIANCUT": Image.MEDIANCUT, "MAXCOVERAGE": Image.MAXCOVERAGE, "FASTOCTREE": Image.FASTOCTREE}
+FORMAT_MAP = {"JPG": ("JPEG", "jpg"), "PNG": ("PNG", "png"), "WEBP": ("WEBP", "webp")}
+POSITIONS = ("top", "left", "bottom", "right")
+
+# Same defaults as the widgets in app.py
+DEFAULT_SETTINGS = {
+    'output_format': "JPG",
+    'webp_lossless': False,
+    'quant_method': "MEDIANCUT",
+    'num_colors': 6,
+    'swatch_size_percent': 20.0,
+    'image_border_percent': 5.0,
+    'swatch_separator_percent': 3.5,
+    'individual_swatch_border_percent': 5.0,
+    'border_color': "#FFFFFF",
+    'swatch_border_color': "#FFFFFF",
+}
+# (min, max) of the numeric sliders in app.py
+SETTING_RANGES = {
+    'num_colors': (2, 12),
+    'swatch_size_percent': (0.0, 100.0),
+    'image_border_percent': (0.0, 20.0),
+    'swatch_separator_percent': (0.0, 20.0),
+    'individual_swatch_border_percent': (0.0, 20.0),
+}
+
+
+class ImageTooLargeError(Exception):
+    pass
+
+
+class ImageDimensionsError(ValueError):
+    pass
+
+
+# --- Utility Functions ---
+def shorten_filename(filename, max_len=25, front_chars=10, back_chars=10):
+    if len(filename) > max_len:
+        name, ext = os.path.splitext(filename)
+        back_chars_name = max(0, back_chars - len(ext))
+        return f"{name[:front_chars]}...{name[-back_chars_name:]}{ext}"
+    return filename
+
+def is_valid_image_header(file_bytes):
+    header = file_bytes[:12]
+    if header.startswith(b'\xFF\xD8\xFF'): return 'jpeg'
+    if header.startswith(b'\x89\x50\x4E\x47\x0D\x0A\x1A\x0A'): return 'png'
+    if header.startswith(b'\x47\x49\x46\x38\x37\x61') or header.startswith(b'\x47\x49\x46\x38\x39\x61'): return 'gif'
+    if header.startswith(b'\x42\x4D'): return 'bmp'
+    if header.startswith(b'\x49\x49\x2A\x00') or header.startswith(b'\x4D\x4D\x00\x2A'): return 'tiff'
+    if header.startswith(b'\x52\x49\x46\x46') and header[8:12] == b'\x57\x45\x42\x50': return 'webp'
+    if header.startswith(b'\x00\x00\x01\x00') or header.startswith(b'\x00\x00\x02\x00'): return 'ico'
+    return None
+
+# --- Color Extraction ---
+def extract_palette(image, num_colors=6, quantize_method=Image.MEDIANCUT):
+    img = image.convert("RGB")
+    try:
+        paletted = img.quantize(colors=num_colors, method=quantize_method, kmeans=5)
+        palette_full = paletted.getpalette()
+        if palette_full is None:
+            paletted = img.quantize(colors=num_colors, method=Image.FASTOCTREE, kmeans=5)
+            palette_full = paletted.getpalette()
+            if palette_full is None: return []
+        
+        actual_palette_colors = len(palette_full) // 3
+        colors_to_extract = min(num_colors, actual_palette_colors)
+        extracted_palette_rgb_values = palette_full[:colors_to_extract * 3]
+        return [tuple(extracted_palette_rgb_values[i:i+3]) for i in range(0, len(extracted_palette_rgb_values), 3)]
+    except Exception:
+        try:
+            paletted = img.quantize(colors=num_colors, method=Image.FASTOCTREE, kmeans=5)
+            palette = paletted.getpalette()
+            if palette is None: return []
+            return [tuple(palette[i:i+3]) for i in range(0, min(num_colors * 3, len(palette)), 3)]
+        except Exception:
+            return []
+
+# --- Draw Layout Function ---
+def draw_layout(image, colors, position, 
+                image_border_percent, swatch_separator_percent, individual_swatch_border_percent,
+                border_color, swatch_border_color, swatch_size_percent_of_shorter_dim):
+    img_w, img_h = image.size
+    shorter_dimension = min(img_w, img_h)
+
+    image_border_thickness_px = int(shorter_dimension * (image_border_percent / 100))
+    swatch_separator_thickness_px = int(shorter_dimension * (swatch_separator_percent / 100))
+    individual_swatch_border_thickness_px = int(shorter_dimension * (individual_swatch_border_percent / 100))
+
+    if image_border_percent > 0 and image_border_thickness_px == 0: image_border_thickness_px = 1
+    if swatch_separator_percent > 0 and swatch_separator_thickness_px == 0: swatch_separator_thickness_px = 1
+    if individual_swatch_border_percent > 0 and individual_swatch_border_thickness_px == 0: individual_swatch_border_thickness_px = 1
+    
+    main_border = image_border_thickness_px
+    actual_swatch_size_px = int(shorter_dimension * (swatch_size_percent_of_shorter_dim / 100))
+    if actual_swatch_size_px <= 0 and swatch_size_percent_of_shorter_dim > 0 : actual_swatch_size_px = 1
+    elif actual_swatch_size_px <= 0: actual_swatch_size_px = 0
+
+    if not colors:
+        if main_border > 0:
+            canvas = Image.new("RGB", (img_w + 2 * main_border, img_h + 2 * main_border), border_color)
+            canvas.paste(image, (main_border, main_border))
+            return canvas
+        return image.copy()
+
+    swatch_width = 0; swatch_height = 0
+    extra_width_for_last_swatch = 0; extra_height_for_last_swatch = 0
+    image_paste_x = main_border; image_paste_y = main_border
+
+    common_canvas_args = {"width_add": 0, "height_add": 0, "swatch_x_or_y_coord": main_border, "paste_offset_dim": 0}
+
+    if position in ['top', 'bottom']:
+        common_canvas_args["height_add"] = actual_swatch_size_px + swatch_separator_thickness_px
+        swatch_total_dim = img_w
+        if len(colors) > 0: swatch_width = swatch_total_dim // len(colors)
+        extra_width_for_last_swatch = swatch_total_dim % len(colors) if len(colors) > 0 else 0
+        if position == 'top':
+            common_canvas_args["paste_offset_dim"] = actual_swatch_size_px + swatch_separator_thickness_px
+            image_paste_y = main_border + common_canvas_args["paste_offset_dim"]
+        else: # bottom
+            common_canvas_args["swatch_x_or_y_coord"] = main_border + img_h + swatch_separator_thickness_px
+    elif position in ['left', 'right']:
+        common_canvas_args["width_add"] = actual_swatch_size_px + swatch_separator_thickness_px
+        swatch_total_dim = img_h
+        if len(colors) > 0: swatch_height = swatch_total_dim // len(colors)
+        extra_height_for_last_swatch = swatch_total_dim % len(colors) if len(colors) > 0 else 0
+        if position == 'left':
+            common_canvas_args["paste_offset_dim"] = actual_swatch_size_px + swatch_separator_thickness_px
+            image_paste_x = main_border + common_canvas_args["paste_offset_dim"]
+        else: # right
+            common_canvas_args["swatch_x_or_y_coord"] = main_border + img_w + swatch_separator_thickness_px
+    else: return image.copy()
+
+    canvas_w = img_w + 2 * main_border + common_canvas_args["width_add"]
+    canvas_h = img_h + 2 * main_border + common_canvas_args["height_add"]
+    
+    canvas = Image.new("RGB", (canvas_w, canvas_h), border_color)
+    canvas.paste(image, (image_paste_x, image_paste_y))
+    draw = ImageDraw.Draw(canvas)
+
+    swatch_x_current = common_canvas_args["swatch_x_or_y_coord"] if position in ['left', 'right'] else main_border
+    swatch_y_current = common_canvas_args["swatch_x_or_y_coord"] if position in ['top', 'bottom'] else main_border
+
+    for i, color_tuple in enumerate(colors):
+        current_sw_w = swatch_width + (extra_width_for_last_swatch if i == len(colors) -1 else 0)
+        current_sw_h = swatch_height + (extra_height_for_last_swatch if i == len(colors) -1 else 0)
+
+        if position in ['top', 'bottom']:
+            rect = [swatch_x_current, swatch_y_current, swatch_x_current + current_sw_w, swatch_y_current + actual_swatch_size_px]
+            draw.rectangle(rect, fill=tuple(color_tuple))
+            if individual_swatch_border_thickness_px > 0 and i < len(colors) - 1:
+                draw.line([(rect[2], rect[1]), (rect[2], rect[3])], fill=swatch_border_color, width=individual_swatch_border_thickness_px)
+            swatch_x_current += current_sw_w
+        else: # left or right
+            rect = [swatch_x_current, swatch_y_current, swatch_x_current + actual_swatch_size_px, swatch_y_current + current_sw_h]
+            draw.rectangle(rect, fill=tuple(color_tuple))
+            if individual_swatch_border_thickness_px > 0 and i < len(colors) - 1:
+                draw.line([(rect[0], rect[3]), (rect[2], rect[3])], fill=swatch_border_color, width=individual_swatch_border_thickness_px)
+            swatch_y_current += current_sw_h
+            
+    if main_border > 0:
+        draw.rectangle([0,0, canvas_w-1, canvas_h-1], outline=border_color, width=main_border)
+
+    if swatch_separator_thickness_px > 0 and actual_swatch_size_px > 0:
+        if position == 'top':
+            line_y = main_border + actual_swatch_size_px
+            draw.line([(main_border, line_y), (canvas_w - main_border -1, line_y)], fill=swatch_border_color, width=swatch_separator_thickness_px)
+        elif position == 'bottom':
+            line_y = main_border + img_h 
+            draw.line([(main_border, line_y), (canvas_w - main_border-1, line_y)], fill=swatch_border_color, width=swatch_separator_thickness_px)
+        elif position == 'left':
+            line_x = main_border + actual_swatch_size_px
+            draw.line([(line_x, main_border), (line_x, canvas_h - main_border -1)], fill=swatch_border_color, width=swatch_separator_thickness_px)
+        elif position == 'right':
+            line_x = main_border + img_w
+            draw.line([(line_x, main_border), (line_x, canvas_h - main_border-1)], fill=swatch_border_color, width=swatch_separator_thickness_px)
+    return canvas
+
+
+# --- Loading, Encoding & Fetching ---
+def load_image(image_bytes):
+    """Verify and reopen image bytes; raises UnidentifiedImageError/IOError on bad data."""
+    img_pil = Image.open(io.BytesIO(image_bytes)); img_pil.verify()
+    return Image.open(io.BytesIO(image_bytes))
+
+def is_within_dimensions(width, height):
+    return MIN_IMAGE_DIM <= width <= MAX_IMAGE_DIM and MIN_IMAGE_DIM <= height <= MAX_IMAGE_DIM
+
+def prepare_image(img_pil):
+    if img_pil.mode not in ("RGB", "L"): img_pil = img_pil.convert("RGB")
+    return img_pil
+
+def safe_output_filename(file_name, pos, extension):
+    safe_base = "".join(c if c.isalnum() or c in (' ','.','_','-') else '_' for c in os.path.splitext(file_name)[0]).rstrip()
+    return f"{safe_base}_{pos}.{extension}"
+
+def get_save_params(img_format, webp_lossless):
+    save_params = {'quality': 95} if img_format == "JPEG" else ({'quality': 85, 'lossless': webp_lossless} if img_format == "WEBP" else {})
+    if img_format == "WEBP" and webp_lossless: save_params['quality'] = 100
+    return save_params
+
+def encode_image(image, img_format, webp_lossless=False):
+    img_byte_arr_output = io.BytesIO()
+    image.save(img_byte_arr_output, format=img_format, **get_save_params(img_format, webp_lossless))
+    return img_byte_arr_output.getvalue()
+
+def render_position(img_pil, palette, pos, settings):
+    return draw_layout(img_pil.copy(), palette, pos, settings['image_border_percent'],
+                       settings['swatch_separator_percent'], settings['individual_swatch_border_percent'],
+                       settings['border_color'], settings['swatch_border_color'], settings['swatch_size_percent'])
+
+def make_preview_thumbnail(result_img, size=(200, 200)):
+    """PNG bytes of the app's preview thumbnail for a rendered output."""
+    preview_thumb = result_img.copy(); preview_thumb.thumbnail(size)
+    with io.BytesIO() as buf:
+        preview_thumb.save(buf, format="PNG")
+        return buf.getvalue()
+
+def generate_swatches(image_bytes, file_name, positions, settings):
+    """Yield (output_filename, output_bytes, palette, thumbnail_png) for each position, as the app does per source."""
+    img_format, extension = FORMAT_MAP[settings['output_format']]
+    img_pil = load_image(image_bytes)
+    w, h = img_pil.size
+    if not is_within_dimensions(w, h):
+        raise ImageDimensionsError(f"`{file_name}` ({w}x{h}) outside dimensions.")
+    img_pil = prepare_image(img_pil)
+    palette = extract_palette(img_pil, settings['num_colors'], QUANT_METHOD_MAP[settings['quant_method']])
+    for pos in positions:
+        result_img = render_position(img_pil, palette, pos, settings)
+        yield (safe_output_filename(file_name, pos, extension), encode_image(result_img, img_format, settings['webp_lossless']),
+               palette, make_preview_thumbnail(result_img))
+
+def fetch_image_url(url, timeout=15):
+    """Download an image URL; returns (file_name, bytes) or None if the bytes are not a known image."""
+    headers = {'User-Agent': 'Mozilla/5.0'}
+    with requests.get(url, timeout=timeout, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        if int(response.headers.get('Content-Length', 0)) > MAX_URL_BYTES:
+            raise ImageTooLargeError("Image from URL is too large (>20MB).")
+        # Content-Length may be missing (chunked) or wrong, so enforce the cap while reading
+        chunks = []; received = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            received += len(chunk)
+            if received > MAX_URL_BYTES: raise ImageTooLargeError("Image from URL is too large (>20MB).")
+            chunks.append(chunk)
+    image_bytes = b"".join(chunks)
+    url_file_name_base = os.path.basename(url.split("?")[0].strip()) or "image_from_url"
+    detected_format = is_valid_image_header(image_bytes[:12])
+    if not detected_format: return None
+    return f"{os.path.splitext(url_file_name_base)[0]}.{detected_format}", image_bytes